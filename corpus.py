@@ -0,0 +1,540 @@
+"""
+Binary corpus of generated PowerGraphs.
+
+Layout (all integers little-endian):
+
+    header      magic "PWGC", version u16, nodetype count u16, footer offset
+                u64, then one registry entry per nodetype: its name, intype
+                names and outtype names (u16-length-prefixed utf-8 strings,
+                with u8 counts for the type lists)
+    data        per power, n_nodes node records followed by n_edges edge
+                records. Nodes are topologically sorted, so a node's
+                arguments always come from earlier nodes
+    index       one entry per power in insertion order, pointing at its data
+    hash table  (hash, index) pairs sorted by hash
+    footer      index offset, hash table offset, power count, magic "PWGE"
+
+The reader mmaps the file and only ever decodes the records it is asked for,
+so opening a corpus costs the header and the footer regardless of its size.
+The writer appends powers to the end of the file and writes the index, hash
+table and footer after them on close, so an existing corpus can be reopened
+and grown. Only then does it point the header at the new footer: until that
+last write the file still opens as the corpus it was before, and the tables
+of earlier sessions are left behind as dead space between the data. The
+writer only keeps the hashes added in the current session in memory: they
+are checked for duplicates against the existing hash table with a binary
+search, and merged into it on close.
+
+regenerate() brings a corpus up to date with the current nodetype catalogue
+without rebuilding it: powers whose nodetypes are all unchanged are copied
+as raw records, powers using removed or changed nodetypes are dropped, and
+only powers that use an added nodetype are generated.
+"""
+
+from bisect import bisect_left
+from collections import namedtuple
+import heapq
+import mmap
+import os
+import shutil
+import struct
+import tempfile
+
+from powers2 import ALL_NODETYPES, InKey, PowerGraph, PowerGraphGenerator
+
+
+MAGIC = b"PWGC"
+FOOTER_MAGIC = b"PWGE"
+VERSION = 1
+
+HEADER = struct.Struct("<4sHHQ")      # magic, version, nodetype count, footer offset
+FOOTER_OFFSET = struct.Struct("<Q")     # the last field of HEADER
+STRING_LENGTH = struct.Struct("<H")
+TYPE_COUNT = struct.Struct("<B")
+NODE_RECORD = struct.Struct("<H")       # nodetype index
+EDGE_RECORD = struct.Struct("<HBHB")    # dst node, arg position, src node, src out index
+INDEX_ENTRY = struct.Struct("<QQHH")    # data offset, hash, n_nodes, n_edges
+HASH_ENTRY = struct.Struct("<QQ")       # hash, index
+FOOTER = struct.Struct("<QQQ4s")        # index offset, hash table offset, count, magic
+
+COPY_CHUNK_SIZE = 1 << 20
+WRITE_BATCH_SIZE = 4096
+
+NodetypeSignature = namedtuple("NodetypeSignature", "name intypes outtypes")
+RegistryDiff = namedtuple("RegistryDiff", "added removed")
+RegenerationReport = namedtuple("RegenerationReport", "kept invalidated generated")
+
+
+def nodetype_signature(nodetype):
+    return NodetypeSignature(
+        nodetype.__name__,
+        tuple(t.__name__ for t in nodetype.INTYPES),
+        tuple(t.__name__ for t in nodetype.OUTTYPES))
+
+
+# Every nodetype a generated power can contain
+DEFAULT_NODETYPES = [InKey] + ALL_NODETYPES
+
+
+def nodetype_from_signature(nodetypes):
+    return dict((nodetype_signature(nodetype), nodetype) for nodetype in nodetypes)
+
+
+def graph_hash(powergraph):
+    """The canonical 64-bit hash of a PowerGraph, as stored in the corpus"""
+    return powergraph.__hash__()
+
+
+def powergraph_to_records(powergraph, index_from_nodetype):
+    """
+    Returns (nodetype indices, edges) for a PowerGraph, where edges are
+    (dst node, arg position, src node, src out index) tuples
+    """
+    order = []
+    visited = set()
+
+    def visit(node):
+        if node in visited:
+            return
+        visited.add(node)
+        for var in node.args:
+            visit(var.source)
+        order.append(node)
+
+    for node in sorted(powergraph.nodes, key=lambda node: node.__class__.__name__):
+        visit(node)
+
+    index_from_node = dict((node, i) for i, node in enumerate(order))
+    nodetype_indices = tuple(index_from_nodetype[node.__class__] for node in order)
+    edges = tuple((dst, position, index_from_node[var.source], var.source.out.index(var))
+                  for dst, node in enumerate(order)
+                  for position, var in enumerate(node.args))
+    return nodetype_indices, edges
+
+
+def powergraph_from_records(nodetypes, nodetype_indices, edges):
+    args_from_node = [[] for _ in nodetype_indices]
+    for dst, position, src, out_index in edges:
+        args_from_node[dst].append((position, src, out_index))
+
+    nodes = []
+    for nodetype_index, args in zip(nodetype_indices, args_from_node):
+        nodes.append(nodetypes[nodetype_index](
+            *[nodes[src].out[out_index] for (_, src, out_index) in sorted(args)]))
+    return PowerGraph(frozenset(nodes))
+
+
+def _copy_buffer(buf, start, end, f):
+    for offset in xrange(start, end, COPY_CHUNK_SIZE):
+        f.write(buf[offset:min(offset + COPY_CHUNK_SIZE, end)])
+
+
+def _hash_position(buf, table_offset, count, graphhash):
+    """Returns the position of the first entry >= graphhash in a sorted hash table"""
+    lo, hi = 0, count
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if HASH_ENTRY.unpack_from(buf, table_offset + mid * HASH_ENTRY.size)[0] < graphhash:
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+
+
+def _find_hash(buf, table_offset, count, graphhash):
+    """Returns the index stored with graphhash in a sorted hash table, or None"""
+    position = _hash_position(buf, table_offset, count, graphhash)
+    if position < count:
+        found_hash, index = HASH_ENTRY.unpack_from(
+            buf, table_offset + position * HASH_ENTRY.size)
+        if found_hash == graphhash:
+            return index
+    return None
+
+
+class _HashTable(object):
+    """
+    A sorted hash table in a buffer, without the powers whose indices are in
+    the sorted list dropped. Indices after a dropped power move down to
+    close the gap.
+    """
+
+    def __init__(self, buf, offset, count, dropped=()):
+        self._buf = buf
+        self._offset = offset
+        self._count = count
+        self._dropped = dropped
+
+    def _is_dropped(self, index):
+        i = bisect_left(self._dropped, index)
+        return i < len(self._dropped) and self._dropped[i] == index
+
+    def __contains__(self, graphhash):
+        index = _find_hash(self._buf, self._offset, self._count, graphhash)
+        return index is not None and not self._is_dropped(index)
+
+    def __iter__(self):
+        for i in xrange(self._count):
+            graphhash, index = HASH_ENTRY.unpack_from(self._buf, self._offset + i * HASH_ENTRY.size)
+            if not self._is_dropped(index):
+                yield graphhash, index - bisect_left(self._dropped, index)
+
+    def write_merged(self, f, new_entries):
+        """Writes this table merged with new_entries, sorted (hash, index) pairs, to f"""
+        if self._dropped:
+            _write_hash_entries(f, heapq.merge(self, new_entries))
+            return
+        # Nothing to renumber: copy the runs between new entries as raw bytes
+        position = 0
+        for graphhash, index in new_entries:
+            next_position = _hash_position(self._buf, self._offset, self._count, graphhash)
+            _copy_buffer(self._buf, self._offset + position * HASH_ENTRY.size,
+                         self._offset + next_position * HASH_ENTRY.size, f)
+            f.write(HASH_ENTRY.pack(graphhash, index))
+            position = next_position
+        _copy_buffer(self._buf, self._offset + position * HASH_ENTRY.size,
+                     self._offset + self._count * HASH_ENTRY.size, f)
+
+
+def _write_hash_entries(f, entries):
+    batch = []
+    for entry in entries:
+        batch.append(HASH_ENTRY.pack(*entry))
+        if len(batch) == WRITE_BATCH_SIZE:
+            f.write(b"".join(batch))
+            batch = []
+    f.write(b"".join(batch))
+
+
+def _write_string(f, s):
+    encoded = s.encode("utf-8")
+    f.write(STRING_LENGTH.pack(len(encoded)))
+    f.write(encoded)
+
+
+def _write_header(f, registry):
+    # The footer offset is filled in by _commit_footer once there is one
+    f.write(HEADER.pack(MAGIC, VERSION, len(registry), 0))
+    for signature in registry:
+        _write_string(f, signature.name)
+        for typenames in (signature.intypes, signature.outtypes):
+            f.write(TYPE_COUNT.pack(len(typenames)))
+            for typename in typenames:
+                _write_string(f, typename)
+
+
+def _commit_footer(f, footer_offset):
+    """
+    Points the header of f at the footer written at footer_offset. Everything
+    else is synced to disk first, so the header never points at a footer
+    that is not there yet
+    """
+    f.flush()
+    os.fsync(f.fileno())
+    f.seek(HEADER.size - FOOTER_OFFSET.size)
+    f.write(FOOTER_OFFSET.pack(footer_offset))
+    f.flush()
+    os.fsync(f.fileno())
+
+
+def _read_header(buf):
+    """Returns (registry, footer offset, offset of the first byte after the header)"""
+    magic, version, n_nodetypes, footer_offset = HEADER.unpack_from(buf, 0)
+    if magic != MAGIC:
+        raise ValueError("Not a power corpus")
+    if version != VERSION:
+        raise ValueError("Unsupported corpus version {0}".format(version))
+    offset = HEADER.size
+
+    def read_string(offset):
+        (length,) = STRING_LENGTH.unpack_from(buf, offset)
+        offset += STRING_LENGTH.size
+        return bytes(buf[offset:offset + length]).decode("utf-8"), offset + length
+
+    registry = []
+    for _ in range(n_nodetypes):
+        name, offset = read_string(offset)
+        typelists = []
+        for _ in range(2):
+            (n_types,) = TYPE_COUNT.unpack_from(buf, offset)
+            offset += TYPE_COUNT.size
+            typenames = []
+            for _ in range(n_types):
+                typename, offset = read_string(offset)
+                typenames.append(typename)
+            typelists.append(tuple(typenames))
+        registry.append(NodetypeSignature(name, *typelists))
+    return registry, footer_offset, offset
+
+
+class Corpus(object):
+    """
+    Read-only, memory-mapped view of a corpus file. Powers are addressed by
+    insertion index or by canonical hash, and built from nodetypes.
+    """
+
+    def __init__(self, path, nodetypes=DEFAULT_NODETYPES):
+        self._file = open(path, "rb")
+        self._buf = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.registry, footer_offset, _ = _read_header(self._buf)
+        if not footer_offset:
+            raise ValueError("Corpus was not closed properly")
+        self._index_offset, self._hash_table_offset, self._count, magic = FOOTER.unpack_from(
+            self._buf, footer_offset)
+        if magic != FOOTER_MAGIC:
+            raise ValueError("Corrupt corpus footer")
+        # Resolved lazily so corpora with nodetypes that no longer exist
+        # can still be opened and copied from
+        self._catalogue = nodetypes
+        self._nodetypes = None
+
+    def __len__(self):
+        return self._count
+
+    def _entry(self, i):
+        if not 0 <= i < self._count:
+            raise IndexError(i)
+        return INDEX_ENTRY.unpack_from(self._buf, self._index_offset + i * INDEX_ENTRY.size)
+
+    def hash_at(self, i):
+        return self._entry(i)[1]
+
+    def index_table(self):
+        """Returns (buffer, offset) of the INDEX_ENTRY records of every power"""
+        return self._buf, self._index_offset
+
+    def records(self, i):
+        """Returns (nodetype indices into self.registry, edges) of the i-th power"""
+        offset, _, n_nodes, n_edges = self._entry(i)
+        nodetype_indices = tuple(
+            NODE_RECORD.unpack_from(self._buf, offset + j * NODE_RECORD.size)[0]
+            for j in range(n_nodes))
+        offset += n_nodes * NODE_RECORD.size
+        edges = tuple(
+            EDGE_RECORD.unpack_from(self._buf, offset + j * EDGE_RECORD.size)
+            for j in range(n_edges))
+        return nodetype_indices, edges
+
+    def index_of(self, graphhash):
+        """Returns the index of the power with the given hash, or None"""
+        return _find_hash(self._buf, self._hash_table_offset, self._count, graphhash)
+
+    def __contains__(self, graphhash):
+        return self.index_of(graphhash) is not None
+
+    def nodetypes(self):
+        """Returns the nodetypes of self.registry, failing if one no longer exists"""
+        if self._nodetypes is None:
+            known = nodetype_from_signature(self._catalogue)
+            missing = [s.name for s in self.registry if s not in known]
+            if missing:
+                raise KeyError("Unknown or changed nodetypes: {0}".format(", ".join(missing)))
+            self._nodetypes = [known[s] for s in self.registry]
+        return self._nodetypes
+
+    def __getitem__(self, i):
+        return powergraph_from_records(self.nodetypes(), *self.records(i))
+
+    def by_hash(self, graphhash):
+        i = self.index_of(graphhash)
+        if i is None:
+            raise KeyError(graphhash)
+        return self[i]
+
+    def __iter__(self):
+        for i in xrange(self._count):
+            yield self[i]
+
+    def close(self):
+        self._buf.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class CorpusWriter(object):
+    """
+    Appends PowerGraphs to a corpus file, skipping powers whose hash is
+    already in it. With append=True an existing corpus is extended using its
+    stored registry, and reads as it was until the writer is closed;
+    otherwise a new one is created for nodetypes. Either way, only powers
+    made of nodetypes can be added.
+    """
+
+    def __init__(self, path, nodetypes=DEFAULT_NODETYPES, append=False):
+        self._count = 0
+        # Index entries are streamed here and copied after the data on close
+        self._index = tempfile.TemporaryFile()
+        # Sorted hashes of the powers already in the corpus, and those added
+        # since it was opened
+        self._base_hashes = None
+        self._new_hashes = []
+        self._new_hash_set = set()
+        # The corpus being appended to. Nothing of it is overwritten, so its
+        # tables stay valid until close and its index is copied then.
+        self._existing = None
+
+        if append and os.path.exists(path):
+            self._existing = Corpus(path)
+            self.registry = self._existing.registry
+            self._count = len(self._existing)
+            self._base_hashes = _HashTable(self._existing._buf,
+                                           self._existing._hash_table_offset, self._count)
+            self._file = open(path, "r+b")
+            self._file.seek(0, os.SEEK_END)
+        else:
+            self.registry = [nodetype_signature(nodetype) for nodetype in nodetypes]
+            self._file = open(path, "wb")
+            _write_header(self._file, self.registry)
+
+        known = nodetype_from_signature(nodetypes)
+        self.index_from_nodetype = dict(
+            (known[signature], i)
+            for i, signature in enumerate(self.registry)
+            if signature in known)
+
+    def __len__(self):
+        return self._count
+
+    def __contains__(self, graphhash):
+        return (graphhash in self._new_hash_set or
+                (self._base_hashes is not None and graphhash in self._base_hashes))
+
+    def _write_power(self, graphhash, nodetype_indices, edges):
+        offset = self._file.tell()
+        self._file.write(b"".join(
+            [NODE_RECORD.pack(nodetype_index) for nodetype_index in nodetype_indices] +
+            [EDGE_RECORD.pack(*edge) for edge in edges]))
+        self._index.write(INDEX_ENTRY.pack(offset, graphhash, len(nodetype_indices), len(edges)))
+        self._count += 1
+
+    def add_records(self, graphhash, nodetype_indices, edges):
+        """
+        Appends a power given as records against self.registry.
+        Returns False if a power with the same hash is already stored
+        """
+        if graphhash in self:
+            return False
+        self._new_hashes.append((graphhash, self._count))
+        self._new_hash_set.add(graphhash)
+        self._write_power(graphhash, nodetype_indices, edges)
+        return True
+
+    def add(self, powergraph):
+        """Appends a PowerGraph. Returns False if it is already stored"""
+        try:
+            records = powergraph_to_records(powergraph, self.index_from_nodetype)
+        except KeyError as e:
+            raise ValueError("Nodetype {0} is not in the corpus registry".format(e.args[0].__name__))
+        return self.add_records(graph_hash(powergraph), *records)
+
+    def extend(self, powergraphs):
+        """Appends every PowerGraph of an iterable, returns how many were new"""
+        return sum(1 for powergraph in powergraphs if self.add(powergraph))
+
+    def copy_from(self, corpus, index_from_old_index):
+        """
+        Copies every power of corpus whose nodetypes all map to this writer's
+        registry through index_from_old_index, and drops the others. Their
+        hashes are merged from corpus's own hash table on close, so corpus
+        must stay open until then. The writer must still be empty.
+        Returns (number of powers copied, number dropped)
+        """
+        if self._count:
+            raise ValueError("copy_from needs an empty writer")
+        dropped = []
+        for i in xrange(len(corpus)):
+            nodetype_indices, edges = corpus.records(i)
+            if all(j in index_from_old_index for j in nodetype_indices):
+                self._write_power(corpus.hash_at(i),
+                                  tuple(index_from_old_index[j] for j in nodetype_indices),
+                                  edges)
+            else:
+                dropped.append(i)
+        self._base_hashes = _HashTable(corpus._buf, corpus._hash_table_offset,
+                                       len(corpus), dropped)
+        return len(corpus) - len(dropped), len(dropped)
+
+    def close(self):
+        index_offset = self._file.tell()
+        if self._existing is not None:
+            _copy_buffer(self._existing._buf, self._existing._index_offset,
+                         self._existing._index_offset + len(self._existing) * INDEX_ENTRY.size,
+                         self._file)
+        self._index.seek(0)
+        shutil.copyfileobj(self._index, self._file)
+
+        hash_table_offset = self._file.tell()
+        new_hashes = sorted(self._new_hashes)
+        if self._base_hashes is None:
+            _write_hash_entries(self._file, new_hashes)
+        else:
+            self._base_hashes.write_merged(self._file, new_hashes)
+
+        footer_offset = self._file.tell()
+        self._file.write(FOOTER.pack(index_offset, hash_table_offset,
+                                     self._count, FOOTER_MAGIC))
+        _commit_footer(self._file, footer_offset)
+        self._file.close()
+        self._index.close()
+        if self._existing is not None:
+            self._existing.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def diff_registry(old_registry, nodetypes=DEFAULT_NODETYPES):
+    """
+    Compares a stored registry with a nodetype catalogue. Returns the
+    nodetypes that are new to the catalogue and the signatures that no
+    longer exist in it. A nodetype whose type signature changed counts as
+    both removed and added.
+    """
+    old_signatures = set(old_registry)
+    new_signatures = set(nodetype_signature(nodetype) for nodetype in nodetypes)
+    return RegistryDiff(
+        added=frozenset(nodetype for nodetype in nodetypes
+                        if nodetype_signature(nodetype) not in old_signatures),
+        removed=frozenset(old_signatures - new_signatures))
+
+
+def regenerate(old_path, new_path, n_new=20, generator=None):
+    """
+    Writes to new_path a corpus matching generator's nodetype catalogue
+    (plus InKey), starting from the corpus at old_path (the two may be the
+    same file).
+
+    Any power without added nodetypes could already be generated before the
+    catalogue changed, so only powers using at least one added nodetype are
+    generated, up to n_new of them. The new corpus is written from scratch,
+    without the dead space earlier appends left. Returns a RegenerationReport.
+    """
+    if generator is None:
+        generator = PowerGraphGenerator()
+    nodetypes = [InKey] + list(generator.nodetypes)
+    tmp_path = new_path + ".tmp"
+
+    with Corpus(old_path, nodetypes) as old:
+        diff = diff_registry(old.registry, nodetypes)
+        with CorpusWriter(tmp_path, nodetypes) as writer:
+            new_index_from_old_index = dict(
+                (i, writer.registry.index(signature))
+                for i, signature in enumerate(old.registry)
+                if signature not in diff.removed)
+            kept, invalidated = writer.copy_from(old, new_index_from_old_index)
+
+            generated = 0
+            if diff.added:
+                generated = writer.extend(generator.generate_unique(
+                    n_new, required_nodetypes=diff.added))
+
+    os.rename(tmp_path, new_path)
+    return RegenerationReport(kept, invalidated, generated)
@@ -0,0 +1,226 @@
+"""
+Structural metrics for PowerGraphs.
+
+graph_metrics walks a single PowerGraph and returns a PowerGraphMetrics row
+of scalars; it backs metric_predicate, which turns a check on that row into
+a generator predicate. corpus_metrics computes the same metrics for every
+power of a corpus with a handful of numpy passes over its memory-mapped node
+and edge records, without building PowerGraphs. Batch results are columnar:
+one array per metric, indexed by the position of the power, so they can be
+used directly for filtering (boolean masks) or ranking (argsort).
+"""
+
+from collections import namedtuple
+import struct
+import numpy as np
+
+from corpus import EDGE_RECORD, INDEX_ENTRY, NODE_RECORD, nodetype_signature
+from powers2 import GameEffect, InputKey, PossiblyRepeatedInputKey, memoize
+
+
+INPUT_KEY_TYPES = frozenset([InputKey.__name__, PossiblyRepeatedInputKey.__name__])
+
+# Powers per numpy pass in corpus_metrics, bounding its memory use
+METRICS_CHUNK_SIZE = 1 << 16
+
+
+def _record_dtype(record, names):
+    """
+    Returns the numpy dtype of a little-endian struct.Struct of unsigned
+    integers, naming its fields in order
+    """
+    codes = record.format[1:]
+    if record.format[0] != "<" or len(codes) != len(names):
+        raise ValueError("Cannot name the fields of {0}".format(record.format))
+    dtype = np.dtype([(name, "<u{0}".format(struct.calcsize("<" + code)))
+                      for name, code in zip(names, codes)])
+    assert dtype.itemsize == record.size
+    return dtype
+
+
+# Layouts of the corpus records, derived from the structs the corpus uses
+INDEX_DTYPE = _record_dtype(INDEX_ENTRY, ("offset", "hash", "n_nodes", "n_edges"))
+NODE_DTYPE = _record_dtype(NODE_RECORD, ("nodetype",))
+EDGE_DTYPE = _record_dtype(EDGE_RECORD, ("dst", "position", "src", "out_index"))
+
+METRIC_NAMES = (
+    "n_nodes",          # number of nodes in the graph
+    "n_edges",          # number of node -> node argument edges
+    "depth",            # number of nodes on the longest path
+    "max_fan_in",       # most arguments consumed by a single node
+    "max_fan_out",      # most consumers fed by a single node
+    "n_game_effects",   # number of GameEffect outputs
+    "n_input_sources",  # number of nodes turning an input key into something else
+)
+
+PowerGraphMetrics = namedtuple("PowerGraphMetrics", METRIC_NAMES)
+
+
+def _is_input_source(signature):
+    """
+    True for nodes like InputClickPosition that consume an input key and
+    produce game values, but not for InKey or SingleInputKey
+    """
+    return (any(t in INPUT_KEY_TYPES for t in signature.intypes) and
+            not any(t in INPUT_KEY_TYPES for t in signature.outtypes))
+
+
+def _signature_counts(signature):
+    """Returns (GameEffect outputs, input sources) of one node of signature"""
+    return (signature.outtypes.count(GameEffect.__name__),
+            int(_is_input_source(signature)))
+
+
+@memoize
+def _nodetype_counts(nodetype):
+    return _signature_counts(nodetype_signature(nodetype))
+
+
+def graph_metrics(powergraph):
+    """
+    Computes every metric in METRIC_NAMES for a single PowerGraph.
+    Returns a PowerGraphMetrics of ints
+    """
+    fan_out = dict.fromkeys(powergraph.nodes, 0)
+    depth = {}
+
+    def node_depth(node):
+        if node not in depth:
+            depth[node] = 1 + max([node_depth(var.source) for var in node.args] or [0])
+        return depth[node]
+
+    n_edges = max_fan_in = n_game_effects = n_input_sources = 0
+    for node in powergraph.nodes:
+        n_edges += len(node.args)
+        max_fan_in = max(max_fan_in, len(node.args))
+        for var in node.args:
+            fan_out[var.source] += 1
+        game_effects, input_sources = _nodetype_counts(node.__class__)
+        n_game_effects += game_effects
+        n_input_sources += input_sources
+
+    return PowerGraphMetrics(
+        n_nodes=len(powergraph.nodes),
+        n_edges=n_edges,
+        depth=max([node_depth(node) for node in powergraph.nodes] or [0]),
+        max_fan_in=max_fan_in,
+        max_fan_out=max(list(fan_out.values()) or [0]),
+        n_game_effects=n_game_effects,
+        n_input_sources=n_input_sources,
+    )
+
+
+def compute_metrics(powergraphs):
+    """
+    Computes every metric in METRIC_NAMES for an iterable of PowerGraphs.
+    Returns a PowerGraphMetrics of int64 arrays, one entry per graph
+    """
+    rows = np.array([graph_metrics(powergraph) for powergraph in powergraphs],
+                    dtype=np.int64).reshape(-1, len(METRIC_NAMES))
+    return PowerGraphMetrics(*rows.T.copy())
+
+
+def _per_graph_max(values, graph_ids, n_graphs):
+    out = np.zeros(n_graphs, dtype=np.int64)
+    np.maximum.at(out, graph_ids, values)
+    return out
+
+
+def _record_offsets(starts, counts, size):
+    """
+    Returns the byte offsets of counts[i] consecutive records of the given
+    size starting at starts[i], for every i
+    """
+    firsts = np.cumsum(counts) - counts
+    positions = np.arange(counts.sum()) - np.repeat(firsts, counts)
+    return np.repeat(starts, counts) + size * positions
+
+
+def _read_field(raw, offsets, dtype, name):
+    """Reads field name of the dtype records starting at offsets in raw"""
+    field, field_offset = dtype.fields[name][:2]
+    values = np.zeros(len(offsets), dtype=np.int64)
+    for i in range(field.itemsize):
+        values |= raw[offsets + field_offset + i].astype(np.int64) << (8 * i)
+    return values
+
+
+def _chunk_metrics(raw, index, game_effects_of_type, input_sources_of_type):
+    n_graphs = len(index)
+    offsets = index["offset"].astype(np.int64)
+    n_nodes = index["n_nodes"].astype(np.int64)
+    n_edges = index["n_edges"].astype(np.int64)
+    first_nodes = np.cumsum(n_nodes) - n_nodes
+
+    graph_ids = np.repeat(np.arange(n_graphs), n_nodes)
+    nodetype_indices = _read_field(
+        raw, _record_offsets(offsets, n_nodes, NODE_DTYPE.itemsize), NODE_DTYPE, "nodetype")
+
+    # Node numbers in edge records are local to their power
+    edge_graph_ids = np.repeat(np.arange(n_graphs), n_edges)
+    edge_offsets = _record_offsets(
+        offsets + n_nodes * NODE_DTYPE.itemsize, n_edges, EDGE_DTYPE.itemsize)
+    destinations = first_nodes[edge_graph_ids] + _read_field(raw, edge_offsets, EDGE_DTYPE, "dst")
+    sources = first_nodes[edge_graph_ids] + _read_field(raw, edge_offsets, EDGE_DTYPE, "src")
+
+    n_nodes_total = len(graph_ids)
+    fan_in = np.bincount(destinations, minlength=n_nodes_total)
+    fan_out = np.bincount(sources, minlength=n_nodes_total)
+
+    # Longest path, relaxed over all edges of all graphs at once. Every pass
+    # extends the known paths by at least one edge, so this terminates after
+    # at most (longest path) passes.
+    depth = np.ones(n_nodes_total, dtype=np.int64)
+    while len(sources):
+        relaxed = depth.copy()
+        np.maximum.at(relaxed, destinations, depth[sources] + 1)
+        if np.array_equal(relaxed, depth):
+            break
+        depth = relaxed
+
+    return PowerGraphMetrics(
+        n_nodes=n_nodes,
+        n_edges=n_edges,
+        depth=_per_graph_max(depth, graph_ids, n_graphs),
+        max_fan_in=_per_graph_max(fan_in, graph_ids, n_graphs),
+        max_fan_out=_per_graph_max(fan_out, graph_ids, n_graphs),
+        n_game_effects=np.bincount(
+            graph_ids, weights=game_effects_of_type[nodetype_indices],
+            minlength=n_graphs).astype(np.int64),
+        n_input_sources=np.bincount(
+            graph_ids, weights=input_sources_of_type[nodetype_indices],
+            minlength=n_graphs).astype(np.int64),
+    )
+
+
+def corpus_metrics(corpus):
+    """
+    Computes every metric in METRIC_NAMES for every power of an open Corpus.
+    Returns a PowerGraphMetrics of int64 arrays, one entry per power
+    """
+    if not len(corpus):
+        return compute_metrics([])
+
+    buf, index_offset = corpus.index_table()
+    raw = np.frombuffer(buf, dtype=np.uint8)
+    index = np.frombuffer(buf, dtype=INDEX_DTYPE, count=len(corpus), offset=index_offset)
+    counts = np.array([_signature_counts(signature) for signature in corpus.registry],
+                      dtype=np.int64).reshape(-1, 2)
+    game_effects_of_type, input_sources_of_type = counts.T
+
+    chunks = [_chunk_metrics(raw, index[start:start + METRICS_CHUNK_SIZE],
+                             game_effects_of_type, input_sources_of_type)
+              for start in xrange(0, len(index), METRICS_CHUNK_SIZE)]
+    return PowerGraphMetrics(*(np.concatenate(column) for column in zip(*chunks)))
+
+
+def metric_predicate(f):
+    """
+    Wraps f, a function from a PowerGraphMetrics row (of scalars) to bool,
+    into a PowerGraph predicate usable with PowerGraphGenerator.generate_unique
+
+    e.g. metric_predicate(lambda m: m.depth <= 5 and m.n_game_effects >= 2)
+    """
+    def predicate(powergraph):
+        return f(graph_metrics(powergraph))
+    return predicate
@@ -45,7 +45,8 @@ import sys
 import itertools
 import xxhash
 import random
-from collections import namedtuple, defaultdict
+from collections import namedtuple, defaultdict, OrderedDict
+from fractions import gcd
 from Queue import Queue
 import networkx as nx
 from networkx.drawing.nx_pydot import write_dot
@@ -57,6 +58,12 @@ OUTPUT_IMAGES = True
 MAX_GAME_EFFECTS_PER_POWER = 3
 MAX_INTERMEDIATE_UNBOUND_VARS = 4
 N_POWERS_TO_GENERATE = 20
+# Bounds that keep the search finite when nodetypes form cycles
+SEARCH_DEPTH_STEP = 16
+MAX_SEARCH_DEPTH = 32
+MAX_CYCLE_REPEATS = 2
+# Search spaces a PowerGraphGenerator keeps, one per start type, end type and predicate
+MAX_CACHED_SEARCH_SPACES = 16
 
 # UTILITIES
 
@@ -64,13 +71,42 @@ N_POWERS_TO_GENERATE = 20
 def memoize(f):
     c = {}
 
-    def g(x):
+    def g(*x):
         if x not in c:
-            c[x] = f(x)
+            c[x] = f(*x)
         return c[x]
     return g
 
 
+def function_key(f):
+    """
+    Returns a hashable key shared by functions that compute the same thing,
+    e.g. the lambdas one line of code creates on every call: their code,
+    captured values, defaults and bound instance. Other callables, or
+    functions capturing unhashable values, are their own key.
+    """
+    code = getattr(f, "__code__", None)
+    if code is None:
+        return f
+    key = (code,
+           tuple(cell.cell_contents for cell in f.__closure__ or ()),
+           f.__defaults__,
+           getattr(f, "__self__", None))
+    try:
+        hash(key)
+    except TypeError:
+        return f
+    return key
+
+
+def random_coprime(n):
+    "Returns a random number in [1, n) sharing no factor with n, or 1 if n is 1"
+    while True:
+        k = random.randrange(1, n) if n > 1 else 1
+        if gcd(k, n) == 1:
+            return k
+
+
 def powerset(iterable):
     "powerset([1,2,3]) --> () (1,) (2,) (3,) (1,2) (1,3) (2,3) (1,2,3)"
     s = list(iterable)
@@ -221,12 +257,11 @@ ALL_NODETYPES = list(itertools.chain(
         outtypes=[Bool],
         formatstrings=["a toggle is held"]),
     # Converters
-# Currently disabled because it forms an infinite loop
-    #create_node_type(
-    #    "HomingProjectileEntity",
-    #    intypes=[EnemyEntityId],
-    #    outtypes=[Projectile],
-    #    formatstrings=["a projectile that homes towards {0}"]),
+    create_node_type(
+        "HomingProjectileEntity",
+        intypes=[EnemyEntityId],
+        outtypes=[Projectile],
+        formatstrings=["a projectile that homes towards {0}"]),
     create_node_type(
         "DumbProjectile",
         intypes=[SimplePath],
@@ -366,7 +401,7 @@ class PowerGraph(object):
         """
 
         def canonical_node_order(nodelist):
-            return sorted(nodelist, key=lambda node: node.__class__.__name__)
+            return sorted(nodelist, key=lambda node: (node.__class__.__name__, hash_node(node)))
 
         @memoize
         def hash_arg(var):
@@ -454,6 +489,71 @@ class PowerGraph(object):
 
         return (cls(nodes) for (nodes, _) in state)
 
+    @classmethod
+    def nth_from_list_of_node_types(cls, nodetypes, n):
+        """
+        Returns the n-th of the graphs all_from_list_of_node_types yields for
+        nodetypes, numbered from 0 to n_wirings_from_list_of_node_types - 1 by
+        the argument picked for every input in turn
+        """
+        nodes = []
+        unused_from_type = defaultdict(list)
+        for nodetype in nodetypes:
+            args = []
+            for intype in nodetype.INTYPES:
+                unused = unused_from_type[intype]
+                n, i = divmod(n, len(unused))
+                args.append(unused.pop(i))
+            node = nodetype(*args)
+            nodes.append(node)
+            for var in node.out:
+                unused_from_type[var.type].append(var)
+        return cls(frozenset(nodes))
+
+    @staticmethod
+    def n_wirings_from_list_of_node_types(nodetypes):
+        """
+        Returns how many graphs all_from_list_of_node_types yields for
+        nodetypes, counting every choice of arguments. Symmetric choices can
+        give the same structure, so this bounds the number of distinct hashes.
+        """
+        n_unused_from_type = defaultdict(int)
+        n_wirings = 1
+        for nodetype in nodetypes:
+            for intype in nodetype.INTYPES:
+                n_wirings *= n_unused_from_type[intype]
+                n_unused_from_type[intype] -= 1
+            for outtype in nodetype.OUTTYPES:
+                n_unused_from_type[outtype] += 1
+        return n_wirings
+
+    @staticmethod
+    def independent_nodetypes(a, b):
+        """True if neither nodetype consumes a type the other one produces"""
+        return not (set(a.OUTTYPES) & set(b.INTYPES) or
+                    set(b.OUTTYPES) & set(a.INTYPES))
+
+    @staticmethod
+    def canonical_nodetype_sequence(nodetypes):
+        """
+        Returns a key shared by every topsorted list of nodetypes that
+        all_from_list_of_node_types would turn into the same set of graphs.
+
+        Two adjacent nodetypes can be swapped without changing that set if
+        neither one consumes a type the other one produces. The key is the
+        lexicographically smallest ordering (by nodetype name) reachable
+        through such swaps, so it also fixes the multiset of nodetypes.
+        """
+        remaining = list(nodetypes)
+        key = []
+        while remaining:
+            available = [i for i, nodetype in enumerate(remaining)
+                         if all(PowerGraph.independent_nodetypes(earlier, nodetype)
+                                for earlier in remaining[:i])]
+            i = min(available, key=lambda i: remaining[i].__name__)
+            key.append(remaining.pop(i))
+        return tuple(key)
+
     def description(self):
         descriptions = []
         for node in self.nodes:
@@ -487,52 +587,271 @@ class PowerGraph(object):
         os.remove("multi.dot")
 
 
+SearchSpace = namedtuple("SearchSpace", "successors steps_to_goal")
+
+
 class PowerGraphGenerator(object):
-    def __init__(self):
-        pass
+    def __init__(self, nodetypes=ALL_NODETYPES):
+        self.nodetypes = nodetypes
+        # Least recently used first
+        self._search_spaces = OrderedDict()
+        self.cyclic_components = self.find_cyclic_components(nodetypes)
+
+    @staticmethod
+    def find_cyclic_components(nodetypes):
+        """
+        Returns a dict mapping every type that lies on a cycle of the type
+        graph to its strongly connected component, i.e. the types it can be
+        turned into and back from (e.g. EnemyEntityId -> Projectile -> EnemyEntityId)
+        """
+        typegraph = nx.DiGraph()
+        for nodetype in nodetypes:
+            for intype in nodetype.INTYPES:
+                for outtype in nodetype.OUTTYPES:
+                    typegraph.add_edge(intype, outtype)
+
+        component_from_type = {}
+        for component in nx.strongly_connected_components(typegraph):
+            typ = next(iter(component))
+            if len(component) > 1 or typegraph.has_edge(typ, typ):
+                for typ in component:
+                    component_from_type[typ] = frozenset(component)
+        return component_from_type
+
+    def add_nodetype(self, state, nodetype):
+        """
+        Returns the state after adding nodetype to state, or None if it cannot
+        be added.
+
+        States are multisets of (type, chain) values. For a type on a cycle,
+        chain counts the nodes that produced it from values of the same
+        cyclic component; every other value has chain 0. A chain that never
+        re-enters a type has at most len(component) - 1 steps, so capping it
+        at len(component) - 1 + MAX_CYCLE_REPEATS only limits re-entries.
+        Inputs take the shortest-chain value of their type, which leaves the
+        most room for later nodes.
+        """
+        remaining = state
+        consumed_chain_from_component = {}
+        for intype in nodetype.INTYPES:
+            values = [value for value in remaining.distinct_elements() if value[0] == intype]
+            if not values:
+                return None
+            value = min(values, key=lambda value: value[1])
+            remaining = remaining - FrozenMultiset([value])
+            component = self.cyclic_components.get(intype)
+            if component is not None:
+                consumed_chain_from_component[component] = max(
+                    consumed_chain_from_component.get(component, 0), value[1])
+
+        outputs = []
+        for outtype in nodetype.OUTTYPES:
+            component = self.cyclic_components.get(outtype)
+            chain = 0
+            if component in consumed_chain_from_component:
+                chain = consumed_chain_from_component[component] + 1
+                if chain > len(component) - 1 + MAX_CYCLE_REPEATS:
+                    return None
+            outputs.append((outtype, chain))
+        return remaining + FrozenMultiset(outputs)
+
+    @staticmethod
+    def goal_states(end_type):
+        return set(FrozenMultiset([end_type] * n)
+                   for n in range(MAX_GAME_EFFECTS_PER_POWER))
+
+    def search_space(self, start_type, end_type, predicate):
+        """
+        Returns the SearchSpace of every state (see add_nodetype) reachable
+        from start_type in at most MAX_SEARCH_DEPTH nodes, through states
+        whose types are goal states or satisfy predicate. For each state it
+        records the next state after every nodetype that can be added to it,
+        and the fewest nodes still needed to reach a goal state. A state
+        missing from steps_to_goal can never reach one; goal states have 0
+        steps.
+        """
+        key = (start_type, end_type, function_key(predicate))
+        if key in self._search_spaces:
+            self._search_spaces[key] = self._search_spaces.pop(key)
+        else:
+            goalstates = self.goal_states(end_type)
+            successors = {}
+            predecessors = defaultdict(set)
+            reached_goals = []
+
+            # Forward: every state the search could enter
+            frontier = [FrozenMultiset([(start_type, 0)])]
+            for _ in range(MAX_SEARCH_DEPTH):
+                next_frontier = []
+                for state in frontier:
+                    transitions = {}
+                    for nodetype in self.nodetypes:
+                        new_state = self.add_nodetype(state, nodetype)
+                        if new_state is None:
+                            continue
+                        new_types = FrozenMultiset(typ for (typ, _) in new_state)
+                        is_goal = new_types in goalstates
+                        if is_goal or predicate(new_types):
+                            transitions[nodetype] = new_state
+                            predecessors[new_state].add(state)
+                            if new_state not in successors:
+                                successors[new_state] = {}
+                                next_frontier.append(new_state)
+                                if is_goal:
+                                    reached_goals.append(new_state)
+                    successors[state] = transitions
+                frontier = next_frontier
+
+            # Backward: distances from the goal states
+            steps_to_goal = dict((state, 0) for state in reached_goals)
+            frontier = reached_goals
+            while frontier:
+                next_frontier = []
+                for state in frontier:
+                    for predecessor in predecessors[state]:
+                        if predecessor not in steps_to_goal:
+                            steps_to_goal[predecessor] = steps_to_goal[state] + 1
+                            next_frontier.append(predecessor)
+                frontier = next_frontier
+
+            self._search_spaces[key] = SearchSpace(successors, steps_to_goal)
+            if len(self._search_spaces) > MAX_CACHED_SEARCH_SPACES:
+                self._search_spaces.popitem(last=False)
+        return self._search_spaces[key]
 
     def generate_valid_topsorted_node_dag(
             self,
             start_type=PossiblyRepeatedInputKey,
             end_type=GameEffect,
-            predicate=lambda types: len(types) <= MAX_INTERMEDIATE_UNBOUND_VARS):
-        goalstates = set()
-        for n in range(MAX_GAME_EFFECTS_PER_POWER):
-            goalstates.add(FrozenMultiset([end_type] * n))
-
-        @memoize
-        def dfs(available_types):
-            """Returns a list of """
-            def can_add_nodetype(nodetype):
-                required_types = FrozenMultiset(nodetype.INTYPES)
-                return required_types.issubset(available_types)
-
-            possible_nodetypes = filter(can_add_nodetype, ALL_NODETYPES)
-            random.shuffle(possible_nodetypes)
-            for nodetype in possible_nodetypes:
-                new_available_types = (available_types - FrozenMultiset(nodetype.INTYPES)
-                                       ) + FrozenMultiset(nodetype.OUTTYPES)
-                if new_available_types in goalstates:
+            predicate=lambda types: len(types) <= MAX_INTERMEDIATE_UNBOUND_VARS,
+            required_nodetypes=frozenset(),
+            exhausted=None):
+        """
+        Returns a topsorted list of nodetypes turning start_type into a goal
+        state, or None if there is none. If required_nodetypes is given, the
+        list contains at least one of them.
+
+        exhausted maps tuples of nodetypes to a depth: no list of at most
+        that many nodetypes starting with the tuple is returned. The search
+        records every prefix it found nothing under in it, so a caller that
+        records each list it is done with gets None exactly when no list
+        is left.
+
+        Of several orderings of the same nodetypes that give the same graphs
+        (see canonical_nodetype_sequence), only ones that cannot move a
+        nodetype in front of an alphabetically later one are returned, so
+        each set of graphs is reached by few lists.
+        """
+        space = self.search_space(start_type, end_type, predicate)
+        if exhausted is None:
+            exhausted = {}
+
+        def can_reach_goal(state, depth_left):
+            return space.steps_to_goal.get(state, depth_left + 1) <= depth_left
+
+        def has_smaller_reordering(path, states, nodetype, new_state):
+            """
+            True if nodetype can be moved in front of an alphabetically
+            later nodetype of path, through states of the search space that
+            are not goals, and still end in new_state
+            """
+            for i in reversed(range(len(path))):
+                if not PowerGraph.independent_nodetypes(path[i], nodetype):
+                    return False
+                if path[i].__name__ > nodetype.__name__:
+                    state = space.successors[states[i]].get(nodetype)
+                    for later in path[i:]:
+                        if state is None or space.steps_to_goal.get(state) == 0:
+                            break
+                        state = space.successors.get(state, {}).get(later)
+                    else:
+                        if state == new_state:
+                            return True
+            return False
+
+        def dfs(path, states, max_depth, has_required):
+            """Returns a list of at most max_depth - len(path) nodetypes leading to a goal state, or None"""
+            depth_left = max_depth - len(path)
+            transitions = list(space.successors[states[-1]].items())
+            random.shuffle(transitions)
+            for nodetype, new_state in transitions:
+                new_path = path + (nodetype,)
+                if exhausted.get(new_path, 0) >= max_depth:
+                    continue
+                if has_smaller_reordering(path, states, nodetype, new_state):
+                    continue
+                new_has_required = has_required or nodetype in required_nodetypes
+                if space.steps_to_goal.get(new_state) == 0 and new_has_required:
                     return [nodetype]
-                elif predicate(new_available_types):
-                    suffix = dfs(new_available_types)
+                elif can_reach_goal(new_state, depth_left - 1):
+                    suffix = dfs(new_path, states + (new_state,), max_depth, new_has_required)
                     if suffix:
                         return [nodetype] + suffix
-
-        return dfs(FrozenMultiset([start_type]))
-
-    def generate_unique(self, n_unique=20, predicate=lambda pg: True):
+            exhausted[path] = max_depth
+            # Entries below path up to the same depth are covered by path now
+            for nodetype, _ in transitions:
+                if exhausted.get(path + (nodetype,), max_depth + 1) <= max_depth:
+                    del exhausted[path + (nodetype,)]
+            return None
+
+        # Iterative deepening in coarse steps: the first bound already covers
+        # every acyclic power, larger ones only come into play when it fails
+        start_state = FrozenMultiset([(start_type, 0)])
+        for max_depth in range(SEARCH_DEPTH_STEP, MAX_SEARCH_DEPTH + 1, SEARCH_DEPTH_STEP):
+            if can_reach_goal(start_state, max_depth) and exhausted.get((), 0) < max_depth:
+                result = dfs((), (start_state,), max_depth, not required_nodetypes)
+                if result:
+                    return result
+        return None
+
+    def generate_unique(self, n_unique=20, predicate=lambda pg: True,
+                        required_nodetypes=frozenset()):
         seen_graph_hashes = set()
+        # Keyed by canonical sequence: (stride, offset, wirings drawn) of a
+        # walk visiting every wiring number of the sequence once, in shuffled
+        # order (see nth_from_list_of_node_types). Each draw builds wirings
+        # of its sequence until one is new, so consecutive outputs rarely
+        # share a sequence. Once the walk is over the sequence is exhausted,
+        # and every list of nodetypes leading to it is handed back to the
+        # search through exhausted_dags so it is never drawn again.
+        walk_from_sequence = {}
+        exhausted_sequences = set()
+        exhausted_dags = {}
         n_output = 0
         while n_output < n_unique:
-            nodetypeslist = [InKey] + self.generate_valid_topsorted_node_dag()
-            for powergraph in PowerGraph.from_list_of_node_types(nodetypeslist):
-                if predicate(powergraph):
-                    graphhash = hash(powergraph)
-                    if graphhash not in seen_graph_hashes:
-                        seen_graph_hashes.add(graphhash)
-                        yield powergraph
-                        n_output += 1
+            dag = self.generate_valid_topsorted_node_dag(
+                required_nodetypes=required_nodetypes, exhausted=exhausted_dags)
+            if dag is None:
+                LOGGER.warning("Every power has been generated, stopping at %d of %d",
+                               n_output, n_unique)
+                return
+            sequence = PowerGraph.canonical_nodetype_sequence([InKey] + dag)
+            if sequence in exhausted_sequences:
+                exhausted_dags[tuple(dag)] = MAX_SEARCH_DEPTH
+                continue
+            n_wirings = PowerGraph.n_wirings_from_list_of_node_types(sequence)
+            if sequence not in walk_from_sequence:
+                walk_from_sequence[sequence] = (
+                    random_coprime(n_wirings), random.randrange(n_wirings), 0)
+            stride, offset, n_drawn = walk_from_sequence[sequence]
+            powergraph = None
+            while n_drawn < n_wirings and powergraph is None:
+                candidate = PowerGraph.nth_from_list_of_node_types(
+                    sequence, (offset + stride * n_drawn) % n_wirings)
+                n_drawn += 1
+                graphhash = hash(candidate)
+                if graphhash not in seen_graph_hashes and predicate(candidate):
+                    seen_graph_hashes.add(graphhash)
+                    powergraph = candidate
+            if n_drawn < n_wirings:
+                walk_from_sequence[sequence] = (stride, offset, n_drawn)
+            else:
+                exhausted_sequences.add(sequence)
+                exhausted_dags[tuple(dag)] = MAX_SEARCH_DEPTH
+                walk_from_sequence.pop(sequence, None)
+            if powergraph is not None:
+                yield powergraph
+                n_output += 1
 
 
 def render_all_nodetypes(filename):